@@ -6,7 +6,7 @@ spawn_and_detect_with_csv.py
 - Spawn a hero vehicle (with LiDAR attached)
 - Set spectator camera to focus on hero vehicle
 - Listen to semantic LiDAR and:
-  1) Save raw point cloud data to lidar_points.csv
+  1) Save raw point cloud data to lidar_points/frame_XXXXXX.npy
   2) Save detection summary to object_log.csv
 """
 
@@ -17,8 +17,11 @@ import time
 import random
 import math
 import logging
-import csv
-from datetime import datetime
+import atexit
+import queue
+import threading
+
+import numpy as np
 
 try:
     sys.path.append(glob.glob('../carla/dist/carla-*%d.%d-%s.egg' % (
@@ -37,14 +40,23 @@ PORT = 2000
 NUM_VEHICLES = 30
 LIDAR_CHANNELS = 64
 LIDAR_PPS = 56000
-LIDAR_FREQ = 80
+FIXED_DELTA_SECONDS = 0.05
+LIDAR_FREQ = 1.0 / FIXED_DELTA_SECONDS  # satu putaran penuh per tick sinkron
 LIDAR_RANGE = 100.0
 HERO_MODEL_FILTER = 'model3'
-RAW_LIDAR_CSV = r"D:\KP_Carla\ObjDetection\lidar_points.csv"
+SUMMARY_TOP_K = 8  # jumlah objek terdekat di ringkasan deteksi
+PRINT_INTERVAL = 0.25  # detik, batas print ringkasan deteksi ke console
+SPECTATOR_MIN_MOVE = 0.05  # meter, perpindahan minimum kendaraan sebelum spectator di-update
+SPECTATOR_MIN_TURN = 0.5  # derajat, perubahan yaw minimum sebelum spectator di-update
+HYBRID_PHYSICS_RADIUS = 70.0  # kendaraan di luar radius ini tidak disimulasikan fisika penuh
+RAW_LIDAR_DIR = r"D:\KP_Carla\ObjDetection\lidar_points"
 DETECTION_LOG_CSV = r"D:\KP_Carla\ObjDetection\object_log.csv"
 # ------------------ #
 
-os.makedirs(os.path.dirname(RAW_LIDAR_CSV), exist_ok=True)
+os.makedirs(RAW_LIDAR_DIR, exist_ok=True)
+# hapus shard dari run sebelumnya (nomor frame bisa berulang), sama seperti log yang di-truncate
+for _old_shard in glob.glob(os.path.join(RAW_LIDAR_DIR, 'frame_*.npy')):
+    os.remove(_old_shard)
 
 # semantic mapping
 object_id = {"None": 0,
@@ -71,20 +83,96 @@ object_id = {"None": 0,
              "Water": 21,
              "Terrain": 22
              }
-key_list = list(object_id.keys())
-value_list = list(object_id.values())
+# id tag sudah rapat 0..N-1, jadi nama bisa diambil langsung lewat index
+assert sorted(object_id.values()) == list(range(len(object_id)))
+TAG_NAMES = [None] * len(object_id)
+for _name, _tag in object_id.items():
+    TAG_NAMES[_tag] = _name
+
+
+def tag_name(tag):
+    return TAG_NAMES[tag] if tag < len(TAG_NAMES) else f"Unknown({tag})"
+
+# layout buffer raw_data semantic LiDAR (lihat SemanticLidarDetection)
+LIDAR_DTYPE = np.dtype([
+    ('x', np.float32), ('y', np.float32), ('z', np.float32),
+    ('CosAngle', np.float32), ('ObjIdx', np.uint32), ('ObjTag', np.uint32)])
+
+# buffer jarak kuadrat minimum per tag, dipakai ulang tiap frame
+MIN_BUF = np.empty(len(object_id), dtype=np.float32)
+_last_print_t = 0.0
 
 actor_list = []
 spawned_vehicle_ids = []
 
-# buat header CSV (sekali saja)
-with open(RAW_LIDAR_CSV, mode='w', newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow(["timestamp", "x", "y", "z", "object_tag"])
 
-with open(DETECTION_LOG_CSV, mode='w', newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow(["timestamp", "detections_summary"])
+def _write_all(fd, buf):
+    """os.write bisa menulis sebagian, ulangi sampai seluruh buffer tertulis"""
+    view = memoryview(buf)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+# buka file CSV sekali saja (fd mentah, tanpa layer file Python) selama simulasi berjalan
+_det_fd = os.open(DETECTION_LOG_CSV,
+                  os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND | getattr(os, 'O_BINARY', 0), 0o644)
+_write_all(_det_fd, b"sim_time,frame,detections_summary\r\n")
+
+# antrian frame dari callback sensor ke thread penulis file
+_write_q = queue.Queue(maxsize=16)
+
+
+def _writer_loop():
+    """Ambil frame dari antrian dan tulis ke disk secara batch"""
+    while True:
+        batch = [_write_q.get()]
+        # ambil sekalian semua frame yang sudah menunggu
+        while batch[-1] is not None:
+            try:
+                batch.append(_write_q.get_nowait())
+            except queue.Empty:
+                break
+        stop = batch[-1] is None
+        if stop:
+            batch.pop()
+
+        # error ditangkap dan di-log supaya thread tetap hidup dan antrian tetap terkuras
+        for timestamp, frame, data, detections_summary in batch:
+            try:
+                np.save(os.path.join(RAW_LIDAR_DIR, f"frame_{frame:06d}.npy"), data)
+            except Exception:
+                logging.exception("Failed to save LiDAR frame %d", frame)
+        # satu encode per batch (isi ringkasan tidak pernah mengandung '"')
+        rows = "".join([f'{timestamp},{frame},"{detections_summary}"\r\n'
+                        for timestamp, frame, _, detections_summary in batch])
+        try:
+            _write_all(_det_fd, rows.encode())
+        except Exception:
+            logging.exception("Failed to write detection log")
+
+        if stop:
+            return
+
+
+_writer_thread = threading.Thread(target=_writer_loop, daemon=True)
+_writer_thread.start()
+
+
+def _stop_writer():
+    if _writer_thread.is_alive():
+        try:
+            _write_q.put(None, timeout=5.0)
+        except queue.Full:
+            logging.warning("Writer queue still full at exit, pending LiDAR frames are discarded")
+        _writer_thread.join(timeout=10.0)
+    if _writer_thread.is_alive():
+        # writer masih menulis; fd dibiarkan terbuka agar tidak menulis ke fd yang sudah ditutup
+        logging.warning("Writer thread still running at exit, leaving detection log open")
+        return
+    os.close(_det_fd)
+
+
+atexit.register(_stop_writer)
 
 
 def generate_lidar_blueprint(blueprint_library):
@@ -97,62 +185,81 @@ def generate_lidar_blueprint(blueprint_library):
 
 
 def semantic_lidar_data(point_cloud_data):
-    """Simpan data mentah + log deteksi objek ke CSV"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-
-    # --- 1️⃣ Simpan raw point cloud ---
-    raw_points = []
-    for detection in point_cloud_data:
-        try:
-            tag = detection.object_tag
-            x, y, z = detection.x, detection.y, detection.z
-        except AttributeError:
-            # fallback untuk versi CARLA lama
-            tag = detection.object_tag
-            x, y, z = detection.point.x, detection.point.y, detection.point.z
-        raw_points.append([timestamp, x, y, z, tag])
-
-    # tulis batch ke CSV
-    with open(RAW_LIDAR_CSV, mode='a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerows(raw_points)
-
-    # --- 2️⃣ Deteksi objek sederhana ---
-    nearest = {}
-    for detection in point_cloud_data:
-        tag = detection.object_tag
-        try:
-            name = key_list[value_list.index(tag)]
-        except ValueError:
-            name = f"Unknown({tag})"
-        try:
-            x, y, z = detection.x, detection.y, detection.z
-        except AttributeError:
-            x, y, z = detection.point.x, detection.point.y, detection.point.z
-        distance = math.sqrt(x ** 2 + y ** 2 + z ** 2)
-        if name not in nearest or distance < nearest[name]:
-            nearest[name] = distance
+    """Hitung ringkasan deteksi lalu kirim frame ke thread penulis"""
+    global MIN_BUF, _last_print_t
+    # waktu simulasi (detik) dari CARLA, tidak perlu strftime tiap frame
+    timestamp = point_cloud_data.timestamp
+
+    data = np.frombuffer(point_cloud_data.raw_data, dtype=LIDAR_DTYPE)
+    tags = data['ObjTag']
+
+    # --- 1️⃣ Deteksi objek sederhana ---
+    # jarak kuadrat dihitung dalam satu pass atas kolom x,y,z (tanpa array sementara
+    # per komponen), lalu diambil minimum per tag
+    xyz = data.view(np.float32).reshape(-1, 6)[:, :3]
+    d2 = np.einsum('ij,ij->i', xyz, xyz)
+    if len(tags) and tags.max() >= len(MIN_BUF):
+        # ada tag di luar object_id (versi CARLA lain), perbesar buffer
+        MIN_BUF = np.empty(int(tags.max()) + 1, dtype=np.float32)
+    min_d2 = MIN_BUF
+    min_d2.fill(np.inf)
+    np.minimum.at(min_d2, tags, d2)
+
+    # ambil K tag terdekat dengan argpartition, baru diurutkan; sqrt hanya untuk K ini
+    present = np.flatnonzero(np.isfinite(min_d2))
+    if len(present) > SUMMARY_TOP_K:
+        present = present[np.argpartition(min_d2[present], SUMMARY_TOP_K - 1)[:SUMMARY_TOP_K]]
+    present = present[np.argsort(min_d2[present])]
 
     detections_summary = ""
-    if nearest:
-        items = sorted(nearest.items(), key=lambda x: x[1])[:8]
-        detections_summary = ", ".join([f"{n}:{d:.2f}" for n, d in items])
-        print(f"Detected (name : distance m) -> {detections_summary}")
+    if len(present):
+        # langsung diformat dari index tag, tanpa list tuple (nama, jarak) di antaranya
+        detections_summary = ", ".join([f"{tag_name(tag)}:{math.sqrt(min_d2[tag]):.2f}"
+                                        for tag in present.tolist()])
+        # print tiap frame terlalu sering (tiap tick), cukup beberapa kali per detik
+        now = time.monotonic()
+        if now - _last_print_t > PRINT_INTERVAL:
+            _last_print_t = now
+            print(f"Detected (name : distance m) -> {detections_summary}")
+
+    # --- 2️⃣ Simpan raw point cloud (.npy) + log deteksi (CSV) di thread penulis ---
+    # raw_data hanya valid selama callback (buffer dipakai ulang CARLA), jadi disalin
+    try:
+        _write_q.put_nowait((timestamp, point_cloud_data.frame, data.copy(), detections_summary))
+    except queue.Full:
+        logging.warning("Writer queue full, dropping LiDAR frame %d", point_cloud_data.frame)
 
-    # --- 3️⃣ Simpan log deteksi ke CSV ---
-    with open(DETECTION_LOG_CSV, mode='a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow([timestamp, detections_summary])
 
+# transform spectator dipakai ulang, hanya field-nya yang diubah tiap update
+_spectator_transform = carla.Transform(carla.Location(), carla.Rotation(pitch=-15.0, roll=0.0))
+# pose kendaraan (x, y, z, yaw) saat spectator terakhir di-update
+_spectator_pose = None
 
-def set_spectator_to_vehicle(world, vehicle, distance_back=8.0, height=4.0):
+
+def set_spectator_to_vehicle(world, vehicle, distance_back=8.0, height=4.0, force=False):
+    global _spectator_pose
     transform = vehicle.get_transform()
-    forward = transform.get_forward_vector()
-    spectator_loc = transform.location - forward * distance_back
-    spectator_loc.z += height
-    spectator_rot = carla.Rotation(pitch=-15.0, yaw=transform.rotation.yaw, roll=0.0)
-    spectator_transform = carla.Transform(spectator_loc, spectator_rot)
-    world.get_spectator().set_transform(spectator_transform)
+    location = transform.location
+    rotation = transform.rotation
+    # lewati update kalau kendaraan praktis belum bergerak sejak update terakhir
+    pose = (location.x, location.y, location.z, rotation.yaw)
+    if not force and _spectator_pose is not None:
+        dx, dy, dz = (pose[i] - _spectator_pose[i] for i in range(3))
+        dyaw = abs((pose[3] - _spectator_pose[3] + 180.0) % 360.0 - 180.0)
+        if dx * dx + dy * dy + dz * dz < SPECTATOR_MIN_MOVE ** 2 and dyaw < SPECTATOR_MIN_TURN:
+            return
+    _spectator_pose = pose
+
+    # forward vector dihitung sendiri dari yaw/pitch (sama dengan get_forward_vector)
+    yaw = math.radians(rotation.yaw)
+    pitch = math.radians(rotation.pitch)
+    cos_pitch = math.cos(pitch)
+    spectator_loc = _spectator_transform.location
+    spectator_loc.x = location.x - cos_pitch * math.cos(yaw) * distance_back
+    spectator_loc.y = location.y - cos_pitch * math.sin(yaw) * distance_back
+    spectator_loc.z = location.z - math.sin(pitch) * distance_back + height
+    _spectator_transform.rotation.yaw = rotation.yaw
+    world.get_spectator().set_transform(_spectator_transform)
 
 
 def spawn_vehicles_batch(client, world, filter='vehicle.*', number=NUM_VEHICLES):
@@ -167,25 +274,29 @@ def spawn_vehicles_batch(client, world, filter='vehicle.*', number=NUM_VEHICLES)
         raise RuntimeError("No spawn points in the map")
 
     n_spawn = min(number, len(spawn_points))
-    random.shuffle(spawn_points)
 
     SpawnActor = carla.command.SpawnActor
     SetAutopilot = carla.command.SetAutopilot
     FutureActor = carla.command.FutureActor
+    tm_port = client.get_trafficmanager().get_port()
 
+    # atribut blueprint dibaca sekali saat blueprint pertama kali terpilih, bukan tiap spawn
+    bp_meta = {}
     batch = []
-    for n, transform in enumerate(spawn_points):
-        if n >= n_spawn:
-            break
+    for transform in random.sample(spawn_points, n_spawn):
         bp = random.choice(blueprints)
-        if bp.has_attribute('color'):
-            color = random.choice(bp.get_attribute('color').recommended_values)
-            bp.set_attribute('color', color)
-        if bp.has_attribute('driver_id'):
-            driver = random.choice(bp.get_attribute('driver_id').recommended_values)
-            bp.set_attribute('driver_id', driver)
-        bp.set_attribute('role_name', 'autopilot')
-        batch.append(SpawnActor(bp, transform).then(SetAutopilot(FutureActor, True, client.get_trafficmanager().get_port())))
+        meta = bp_meta.get(bp.id)
+        if meta is None:
+            colors = list(bp.get_attribute('color').recommended_values) if bp.has_attribute('color') else None
+            drivers = list(bp.get_attribute('driver_id').recommended_values) if bp.has_attribute('driver_id') else None
+            bp.set_attribute('role_name', 'autopilot')
+            meta = bp_meta[bp.id] = (colors, drivers)
+        colors, drivers = meta
+        if colors:
+            bp.set_attribute('color', random.choice(colors))
+        if drivers:
+            bp.set_attribute('driver_id', random.choice(drivers))
+        batch.append(SpawnActor(bp, transform).then(SetAutopilot(FutureActor, True, tm_port)))
 
     responses = client.apply_batch_sync(batch, True)
     spawned_ids = []
@@ -201,10 +312,21 @@ def main():
     logging.basicConfig(level=logging.INFO)
     client = carla.Client(HOST, PORT)
     client.set_timeout(10.0)
+    traffic_manager = None
+    original_settings = None
 
     try:
         world = client.get_world()
+        original_settings = world.get_settings()
+        settings = world.get_settings()
+        settings.synchronous_mode = True
+        settings.fixed_delta_seconds = FIXED_DELTA_SECONDS
+        world.apply_settings(settings)
+
         traffic_manager = client.get_trafficmanager()
+        traffic_manager.set_synchronous_mode(True)
+        traffic_manager.set_hybrid_physics_mode(True)
+        traffic_manager.set_hybrid_physics_radius(HYBRID_PHYSICS_RADIUS)
         traffic_manager.global_percentage_speed_difference(0.0)
 
         blueprint_library = world.get_blueprint_library()
@@ -216,6 +338,8 @@ def main():
             hero_bp = hero_bp_list[0]
 
         spawn_point = world.get_map().get_spawn_points()[0]
+        # hybrid physics mengukur radius dari kendaraan dengan role_name 'hero'
+        hero_bp.set_attribute('role_name', 'hero')
         hero_vehicle = world.spawn_actor(hero_bp, spawn_point)
         actor_list.append(hero_vehicle)
         print(f"Spawned hero vehicle id={hero_vehicle.id}")
@@ -233,26 +357,34 @@ def main():
         actor_list.append(lidar)
         print("LiDAR attached to hero vehicle.")
 
-        set_spectator_to_vehicle(world, hero_vehicle, distance_back=10.0, height=5.0)
+        set_spectator_to_vehicle(world, hero_vehicle, distance_back=10.0, height=5.0, force=True)
         print("Spectator camera set to hero vehicle view.")
 
         # callback LiDAR
         lidar.listen(lambda data: semantic_lidar_data(data))
 
         print("Simulation running. Press Ctrl+C to stop.")
-        settings = world.get_settings()
-        synchronous = settings.synchronous_mode
         while True:
-            if synchronous:
-                world.tick()
-            else:
-                world.wait_for_tick()
+            # world selalu sinkron di sini; tick() sudah menahan loop sesuai laju server
+            world.tick()
+            # spectator hanya di-update kalau kendaraan bergerak melewati threshold
             set_spectator_to_vehicle(world, hero_vehicle, distance_back=10.0, height=5.0)
-            time.sleep(0.05)
 
     except KeyboardInterrupt:
         print("Interrupted by user. Cleaning up...")
     finally:
+        # kembalikan mode async dulu supaya server tetap jalan saat actor dihancurkan
+        if original_settings is not None:
+            try:
+                world.apply_settings(original_settings)
+            except Exception:
+                logging.exception("Failed to restore world settings")
+        if traffic_manager is not None:
+            try:
+                traffic_manager.set_synchronous_mode(False)
+            except Exception:
+                logging.exception("Failed to disable Traffic Manager synchronous mode")
+
         print("Destroying actors...")
         try:
             client.apply_batch([carla.command.DestroyActor(x) for x in spawned_vehicle_ids])